@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""
+gemini_extractor
+使用 Google Gemini 模型擷取 PDF 內容的共用模組。
+"""
+
+from gemini_extractor.core import find_pdf_files, main, process_large_pdf, run
+
+__all__ = ["find_pdf_files", "main", "process_large_pdf", "run"]
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+
+"""
+gemini_extractor/core.py
+使用 Google Gemini 2.5 Pro 模型擷取 PDF 中文內容（單輪分片 + 自動頁碼標註）。
+每批獨立呼叫模型，避免多輪對話遺漏或空白問題。
+自動在輸出中加入頁碼段落標註。
+
+gemini_pdf_extractor.py 與 gemini_pdf_extractor_folder.py 皆由此模組的 main() 執行；
+匯入本模組不會讀取命令列參數或設定 API 金鑰。
+"""
+
+import os
+import sys
+import re
+import math
+import mmap
+import json
+import asyncio
+import hashlib
+import logging
+import textwrap
+from dataclasses import dataclass, field
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from pypdf import PdfReader
+import google.generativeai as genai
+from google.generativeai import caching
+from aiolimiter import AsyncLimiter
+import blake3
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+# === 載入 .env 檔案（環境變數設定需在讀取前載入） ===
+load_dotenv()
+
+# === 模型與快取設定 ===
+MODEL_NAME = "gemini-2.5-pro"
+PROMPT_VERSION = "v2"  # 修改 prompt 時請遞增，使舊的快取失效
+CONTEXT_CACHE_TTL = timedelta(hours=1)  # Gemini context cache 存活時間
+CONTEXT_CACHE_MARGIN = timedelta(minutes=10)  # 剩餘效期不足時先延長，避免批次執行途中過期
+CONTEXT_CACHE_RECREATE_LIMIT = 2  # context cache 失效後最多重建次數，超過改為每批完整送出
+CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", ".gemini_cache")
+FILE_INDEX_PATH = os.path.join(CACHE_DIR, "files.json")  # 已上傳檔案的紀錄
+FILE_REUSE_MARGIN = timedelta(hours=2)  # 上傳檔案剩餘效期不足時重新上傳
+
+# === 並行與限速設定 ===
+AUTO_CHUNK_SIZE = 100  # 未指定每批頁數時，依總頁數平均分批，每批最多 100 頁
+MIN_CHUNK_SIZE = 5  # 輸入過長或輸出被截斷時對半拆批，拆到這個頁數為止
+PDF_CONCURRENCY = int(os.getenv("GEMINI_PDF_CONCURRENCY", "3"))  # 同時準備（讀取頁數、計算雜湊）的 PDF 數量
+UPLOAD_PARALLEL = int(os.getenv("GEMINI_UPLOAD_PARALLEL", "2"))  # 同時上傳的 PDF 數量（上傳會把檔案讀入記憶體）
+GEN_PARALLEL = int(os.getenv("GEMINI_GEN_PARALLEL", os.getenv("GEMINI_CONCURRENCY", "16")))  # 同時呼叫模型的批次 worker 數量
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))  # 所有 PDF 共用的每分鐘請求上限
+
+logger = logging.getLogger("gemini_extract")
+
+
+def setup_logging(quiet: bool = False) -> QueueListener:
+    """各協程只把紀錄放進佇列，由背景執行緒統一輸出到 stdout"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+
+    logger.handlers[:] = [QueueHandler(log_queue)]
+    logger.setLevel(logging.WARNING if quiet else logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+
+# === 提示詞 ===
+# 固定的規範部分只建立一次，每批請求都以相同前綴送出，方便 Gemini 快取重複使用
+# === 🧩 請自行貼上完整 prompt ===
+SPEC_PROMPT = textwrap.dedent("""
+請依照以下提供的《文檔分析與轉錄規範》，進行高保真度的內容擷取與結構化整理。
+輸出需完整保留原始資訊的語意與上下文，並按照**小節分隔**：
+- 每個小節應完整呈現一個主題或概念，文字、表格、公式及圖表文字描述合計約 1000–2000 字，盡量保持邏輯連貫。  
+- 接近上限時自動結束小節並加上標記：
+  `（第X章節結束）`  
+  X 為小節編號，自動累加。
+
+請**直接輸出結果，不需多餘回應**，並確保依照原文語言內容撰寫：中文保持中文，英文或其他語言保持原文。
+
+---
+
+## 文檔分析與轉錄規範
+
+#### 角色 (Role)
+你是一位專業的文檔分析專家，擅長從包含文字、圖表和複雜排版的 PDF 文件中，進行高保真度的資訊擷取與結構化整理。你的任務是將指定的 PDF 頁面內容，一絲不苟地轉換為一份清晰、完整、且易於閱讀的文字稿。
+
+#### 任務目標 (Objective)
+精準地處理使用者提供的 PDF 檔案與指定的頁碼範圍，將所有內容（文字、圖表、表格等）轉換為結構化的文字格式。核心目標是**完全保留原始資訊的完整性與上下文關係**。
+
+---
+
+#### 核心指令 (Core Instructions)
+
+1. **頁碼範圍 (Page Range):**
+   - 嚴格僅處理使用者指定的頁碼範圍（例如：`第 1–50 頁`）。完全忽略範圍外的任何內容。
+
+2. **內容擷取原則 (Extraction Principles):**
+   - **主要文本優先:** 以文章的主體內容為核心，依序擷取。
+   - **忽略非核心元素:** 除非特別指示，否則應**忽略**頁首、頁尾、頁碼、以及不影響文意理解的邊緣裝飾圖案。
+   - **段落定義:** 一個「段落」是指一組語義上連續的句子，通常以縮排或換行分隔。即使在原始文件中因排版而斷行，只要語義連續，就應視為同一段落。
+   - **跨頁段落處理:** 若一個段落從第 X 頁結尾開始，並在第 X+1 頁開頭結束，請將其合併為單一段落，並使用其**起始頁碼**進行標記，即 `【第X頁, 段落Y】`。  
+     合併後的段落不得省略或刪減任何字詞，確保語意連續。
+   - **特殊格式文本:** 程式碼區塊、數學公式或引文等特殊格式，請盡可能保留其原始排版，並使用 Markdown 的程式碼區塊 (```) 或引用 (>) 格式來呈現。  
+     所有原始語言（例如英文變數名稱或公式符號）請保持不變，不得翻譯或改寫。
+
+3. **視覺與表格元素處理 (Visual & Tabular Elements):**
+   - **識別與分類:** 當遇到任何非文字內容時，需識別其類型，例如：`圖表` (Chart/Graph)、`示意圖` (Diagram)、`照片` (Photo)、`流程圖` (Flowchart)、`表格` (Table)。
+   - **深入描述 (Description & Insight):**
+     - 對於**圖表、示意圖、流程圖**，不僅要描述其外觀，更要提煉其**核心洞見**。說明該圖表要傳達的主要訊息、數據趨勢、組件之間的關係或流程的步驟。描述應為**完整、有意義的句子**。
+     - 對於**照片或插圖**，描述其內容以及它在上下文中的作用（例如：展示產品外觀、營造特定氛圍等）。
+   - **表格轉錄 (Table Transcription):**
+     - 將表格內容完整地轉換為 **Markdown 表格格式**。確保所有欄位標題和儲存格資料都被準確無誤地轉錄。
+     - 若表格過於複雜無法用 Markdown 呈現，則以條列式清晰描述其結構與內容。  
+     所有元素（段落、視覺、表格）請依照它們在原始文件中的出現順序排列輸出，不得重排。
+
+---
+
+#### 輸出格式 (Output Format)
+
+* **段落 (Paragraph):**
+  `【第X頁, 段落Y】`
+  [此處為段落的完整文字內容]
+
+* **視覺元素 (Visual Element):**
+  `【第X頁, 視覺元素Y: [類型]】`
+  > [此處為對該視覺元素的深入文字描述與洞見分析]
+
+* **表格 (Table):**
+  `【第X頁, 表格Y】`
+  [此處為使用 Markdown 格式轉錄的完整表格]
+
+* **小節結束標記:**
+  在每個小節約 1000–2000 字結束時，請加上：
+  `（第X章節結束）`  
+  X 為小節編號，自動累加。
+
+* **編號規則 (Numbering Rule):**
+  所有元素（段落、視覺元素、表格）的編號 Y 在每一頁都從 1 重新開始計算。
+
+---
+
+#### 輸出格式範例 (Example)
+請僅輸出以下格式的結果，不要加入任何額外解釋、評論或說明文字。
+````
+
+【第10頁, 段落1】
+本章節旨在介紹現代電路學的基本原理，並探討能量如何在封閉迴路中進行傳導。我們將從最基礎的元件開始。
+
+【第10頁, 視覺元素1: 示意圖】
+
+> 一張電路示意圖，展示一顆電池（標示正負極）透過導線連接一個電阻器，形成一個閉合迴路。圖中用箭頭清晰標示了傳統電流（I）從正極流向負極的方向，同時也暗示了電子流的相反路徑。此圖旨在說明構成基本電路的三個要素：電源、導線與負載。
+
+【第11頁, 段落1】
+根據德國物理學家格奧爾格·歐姆提出的歐姆定律，電路中的電壓、電流與電阻之間存在線性關係，數學表達式為 V = IR。
+
+【第11頁, 表格1】
+
+| 實驗序號 | 電壓 (V) | 電流 (A) | 電阻 (Ω) |
+| :--- | :----- | :----- | :----- |
+| 1    | 5.0    | 0.5    | 10.0   |
+| 2    | 10.0   | 1.0    | 10.0   |
+| 3    | 12.0   | 0.6    | 20.0   |
+
+【第12頁, 段落1】
+基於上述定律，我們可以進一步分析更複雜的電路結構，例如串聯電路與並聯電路。這兩種連接方式在現實世界的電子設備中有著廣泛的應用。
+
+（第1章節結束）
+
+```
+""")
+
+
+# 每批只有頁碼不同：模板在載入時 dedent 一次，之後只做 str.format
+PAGE_PROMPT_TEMPLATE = textwrap.dedent("""
+我現在要處理這份 PDF 的 **第 {start_page}–{end_page} 頁**。
+請你嚴格僅處理這個頁碼範圍內的內容，絕對不要跨出或提前引用其他頁的資訊。
+請依照上述《文檔分析與轉錄規範》直接輸出結果。
+""")
+
+
+def build_prompt(start_page: int, end_page: int) -> str:
+    """產生指定頁碼範圍的 prompt（只包含每批不同的部分）"""
+    return PAGE_PROMPT_TEMPLATE.format(start_page=start_page, end_page=end_page)
+
+
+# === 回應格式檢查 ===
+MARKER_PATTERN = re.compile(r"【第\d+頁, (段落|視覺元素|表格)\d+", re.M)
+VALIDATION_ATTEMPTS = 2  # 格式不符時附上錯誤說明重試一次
+
+
+def marker_floor(start_page: int, end_page: int) -> int:
+    """合格回應至少要有的頁碼標註數（每 4 頁至少 1 個，容許空白頁）"""
+    return max(1, (end_page - start_page + 1) // 4)
+
+
+def build_feedback(marker_count: int) -> str:
+    """格式不符時，接在上一次輸出之後的錯誤說明"""
+    return (
+        f"你上一次的輸出格式有誤：只找到 {marker_count} 個「【第X頁, 段落Y】」形式的標註。"
+        "請修正並依照《文檔分析與轉錄規範》重新輸出這個頁碼範圍的完整結果。"
+    )
+
+
+# === PDF 資訊 ===
+def count_pages(pdf_path: str) -> int:
+    """讀取頁面樹根節點的 /Count 取得總頁數，不必展開每一頁"""
+    reader = PdfReader(pdf_path, strict=False)
+    try:
+        return int(reader.trailer["/Root"]["/Pages"]["/Count"])
+    except (KeyError, TypeError, ValueError):
+        return len(reader.pages)  # 頁面樹不完整時退回逐頁計算
+
+
+# === 回應快取 ===
+def file_digest(path: str) -> str:
+    """計算檔案的 BLAKE3 雜湊（每個 PDF 只計算一次，大檔以多執行緒計算）"""
+    h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()  # 空檔案無法 mmap
+        # 直接對映檔案內容計算，不複製到 Python bytes，整個檔案一次交給多執行緒雜湊
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            h.update(mm)
+    return h.hexdigest()
+
+
+def cache_key(pdf_digest: str, prompt: str, start_page: int, end_page: int) -> str:
+    """以 (PDF 內容, prompt 版本, prompt, 頁碼範圍, 模型) 組成快取鍵"""
+    h = hashlib.sha256()
+    for part in (pdf_digest, PROMPT_VERSION, prompt, f"{start_page}-{end_page}-{MODEL_NAME}"):
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def cache_get(key: str):
+    """讀取快取項目（回應文字 text，或批次拆分點 split_at），沒有快取時回傳 None"""
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_put(key: str, **entry):
+    """寫入快取（先寫暫存檔再替換，避免中斷時留下半個檔案）"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            **entry,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "model": MODEL_NAME,
+            "prompt_version": PROMPT_VERSION,
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# === 上傳檔案重複使用 ===
+def load_file_index() -> dict:
+    """讀取已上傳檔案的紀錄（以 PDF 雜湊為鍵）"""
+    try:
+        with open(FILE_INDEX_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def remember_uploaded_file(pdf_digest: str, uploaded_file):
+    """記錄上傳的檔案，下次執行時可直接沿用"""
+    index = load_file_index()
+    index[pdf_digest] = {
+        "file_name": uploaded_file.name,
+        "file_uri": uploaded_file.uri,
+        "expires_at": uploaded_file.expiration_time.isoformat(),
+    }
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{FILE_INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, FILE_INDEX_PATH)
+
+
+async def find_uploaded_file(pdf_digest: str):
+    """尋找先前上傳且仍有效的同一份 PDF，找不到時回傳 None"""
+    entry = load_file_index().get(pdf_digest)
+    if entry is None:
+        return None
+
+    expires_at = datetime.fromisoformat(entry["expires_at"])
+    if expires_at - datetime.now(timezone.utc) < FILE_REUSE_MARGIN:
+        return None
+
+    try:
+        uploaded_file = await asyncio.to_thread(genai.get_file, entry["file_name"])
+    except Exception:
+        return None
+    return uploaded_file if uploaded_file.state.name == "ACTIVE" else None
+
+
+async def wait_until_active(uploaded_file):
+    """輪詢上傳檔案的狀態直到 ACTIVE，處理失敗時拋出錯誤"""
+    delay = 0.2
+    while uploaded_file.state.name == "PROCESSING":
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+        uploaded_file = await asyncio.to_thread(genai.get_file, uploaded_file.name)
+
+    if uploaded_file.state.name == "FAILED":
+        raise RuntimeError(f"Gemini 無法處理上傳的檔案：{uploaded_file.name}")
+    return uploaded_file
+
+
+# === API 呼叫（指數退避重試） ===
+RETRYABLE_ERRORS = {
+    google_exceptions.ResourceExhausted: 429,
+    google_exceptions.ServiceUnavailable: 503,
+    google_exceptions.DeadlineExceeded: 504,
+}
+RETRY_COUNTS = {code: 0 for code in RETRYABLE_ERRORS.values()}
+
+
+def count_retry(retry_state):
+    """記錄各錯誤碼的重試次數"""
+    error = retry_state.outcome.exception()
+    code = next(code for error_type, code in RETRYABLE_ERRORS.items() if isinstance(error, error_type))
+    RETRY_COUNTS[code] += 1
+    logger.warning(f"🔁 遇到 {code} 錯誤，{retry_state.next_action.sleep:.1f} 秒後重試（第 {retry_state.attempt_number} 次失敗）")
+
+
+@retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=2, max=60),
+    retry=retry_if_exception_type(tuple(RETRYABLE_ERRORS)),
+    before_sleep=count_retry,
+    reraise=True,
+)
+async def generate_with_retry(model, contents, limiter: AsyncLimiter) -> tuple:
+    """呼叫 Gemini，回傳 (文字, 結束原因)；遇到 429/503/504 時以指數退避加抖動重試"""
+    async with limiter:
+        response = await model.generate_content_async(contents, safety_settings=None)
+
+    # 整批回應要先通過格式檢查才寫入與快取，因此不使用串流
+    if not response.candidates:  # prompt 被擋下時沒有候選回應
+        return "", ""
+    text = response.text if response.parts else ""  # 沒有 parts 時 .text 會拋出例外
+    return text, response.candidates[0].finish_reason.name
+
+
+async def create_context_cache(uploaded_file):
+    """把固定規範與上傳的 PDF 建成 Gemini context cache，失敗時回傳 None"""
+    try:
+        return await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=MODEL_NAME,
+            display_name=uploaded_file.display_name,
+            system_instruction=SPEC_PROMPT,
+            contents=[uploaded_file],
+            ttl=CONTEXT_CACHE_TTL,
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ 無法建立 context cache，改為每批完整送出：{e}")
+        return None
+
+
+# === 主處理函式 ===
+def plan_page_ranges(total_pages: int, chunk_size: int = None) -> list:
+    """切分頁碼範圍；未指定每批頁數時，依總頁數平均分成每批不超過 AUTO_CHUNK_SIZE 頁"""
+    if chunk_size is None:
+        num_chunks = math.ceil(total_pages / AUTO_CHUNK_SIZE)
+        chunk_size = math.ceil(total_pages / num_chunks)
+    return [
+        (start_page, min(start_page + chunk_size - 1, total_pages))
+        for start_page in range(1, total_pages + 1, chunk_size)
+    ]
+
+
+@dataclass
+class PdfJob:
+    """一份 PDF 的處理狀態；各批次結果以起始頁為鍵存放，全部完成後依頁碼順序寫出"""
+    pdf_path: str
+    output_file_path: str
+    total_pages: int
+    pdf_digest: str = None  # None 表示停用快取
+    model: object = None
+    uploaded_file: object = None
+    use_context_cache: bool = False  # 有多批要送時（含拆半後），第一批開始執行前才建立 context cache
+    context_cache_disabled: bool = False  # 建立失敗或重建次數用完，改為每批完整送出
+    context_cache: object = None
+    cache_expires_at: datetime = None
+    cache_recreated: int = 0
+    model_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    todo: list = field(default_factory=list)  # 需要呼叫 API 的 (起始頁, 結束頁)
+    results: dict = field(default_factory=dict)  # 起始頁 -> (結束頁, 要寫入的文字或 None)
+    pending: int = 0  # 尚未完成的批次數（批次拆半時會增加）
+    next_page: int = 1  # 下一個要寫入輸出檔的頁碼
+    output: object = None  # 寫入中的暫存輸出檔
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.pdf_path)
+
+    @property
+    def pages_done(self) -> int:
+        return sum(end_page - start_page + 1 for start_page, (end_page, _) in self.results.items())
+
+    def cache_key(self, start_page: int, end_page: int):
+        if self.pdf_digest is None:
+            return None
+        return cache_key(self.pdf_digest, SPEC_PROMPT + build_prompt(start_page, end_page), start_page, end_page)
+
+    @property
+    def part_path(self) -> str:
+        return self.output_file_path + ".part"
+
+    def drain(self):
+        """把從 next_page 開始、已連續完成的批次依頁碼順序寫入暫存輸出檔"""
+        if self.output is None:
+            self.output = open(self.part_path, "w", encoding="utf-8", buffering=1 << 20)
+            self.output.write(f"從 PDF 「{self.name}」 擷取的文字內容\n")
+            self.output.write("=" * 80 + "\n\n")
+        while self.next_page in self.results:
+            end_page, text = self.results[self.next_page]
+            if text is not None:
+                self.output.write(text)
+            self.next_page = end_page + 1
+        self.output.flush()
+
+    def set_result(self, start_page: int, end_page: int, text: str = None):
+        """存入批次結果，加上批次標頭與分隔線"""
+        if text is not None:
+            batch_header = f"\n\n===== {self.name} | 第 {start_page}–{end_page} 頁 =====\n\n"
+            batch_footer = "\n" + "=" * 80 + "\n"
+            text = batch_header + text.strip() + batch_footer
+        self.results[start_page] = (end_page, text)
+
+    def resolve_cached(self, start_page: int, end_page: int) -> list:
+        """從快取填入結果（會追蹤先前拆半的批次），回傳仍需呼叫 API 的頁碼範圍"""
+        key = self.cache_key(start_page, end_page)
+        entry = cache_get(key) if key is not None else None
+        if entry is not None and "split_at" in entry:
+            split_at = entry["split_at"]
+            return self.resolve_cached(start_page, split_at) + self.resolve_cached(split_at + 1, end_page)
+        if entry is not None and "text" in entry:
+            self.set_result(start_page, end_page, entry["text"])
+            return []
+        return [(start_page, end_page)]
+
+
+async def prepare_pdf(pdf_path: str, output_file_path: str, chunk_size: int = None, use_cache: bool = True,
+                      upload_semaphore: asyncio.Semaphore = None):
+    """讀取頁數、查詢快取並上傳檔案，回傳 PdfJob（無法處理時回傳 None）"""
+
+    logger.info(f"🔍 正在讀取 PDF: {pdf_path}...")
+    try:
+        total_pages = await asyncio.to_thread(count_pages, pdf_path)
+        logger.info(f"📄 文件總頁數: {total_pages} 頁")
+    except Exception as e:
+        logger.error(f"❌ 無法讀取 PDF：{e}")
+        return None
+
+    if total_pages == 0:
+        logger.error("❌ 錯誤：此 PDF 沒有頁面。")
+        return None
+
+    job = PdfJob(pdf_path=pdf_path, output_file_path=output_file_path, total_pages=total_pages)
+    page_ranges = plan_page_ranges(total_pages, chunk_size)
+
+    # === 查詢回應快取（PDF 雜湊只計算一次） ===
+    if use_cache:
+        job.pdf_digest = await asyncio.to_thread(file_digest, pdf_path)
+        for start_page, end_page in page_ranges:
+            job.todo += job.resolve_cached(start_page, end_page)
+        logger.info(f"💾 快取命中 {job.pages_done}/{total_pages} 頁")
+    else:
+        job.todo = page_ranges
+
+    if not job.todo:
+        return job
+
+    # === 上傳檔案至 Gemini（全部命中快取時略過） ===
+    if job.pdf_digest is not None:
+        job.uploaded_file = await find_uploaded_file(job.pdf_digest)
+    if job.uploaded_file is not None:
+        logger.info(f"♻️ 沿用先前上傳的檔案：{job.uploaded_file.uri}")
+    else:
+        logger.info("☁️ 正在上傳檔案至 Google AI Studio...")
+        async with upload_semaphore or asyncio.Semaphore(UPLOAD_PARALLEL):  # 只限制上傳本身，不影響其他 PDF 讀取或呼叫模型
+            uploaded_file = await asyncio.to_thread(
+                genai.upload_file, path=pdf_path, display_name=os.path.basename(pdf_path)
+            )
+        job.uploaded_file = await wait_until_active(uploaded_file)  # 等待後端索引完成
+        logger.info(f"✅ 上傳成功！File URI: {job.uploaded_file.uri}")
+        if job.pdf_digest is not None:
+            remember_uploaded_file(job.pdf_digest, job.uploaded_file)
+
+    # === 多批未命中時以 context cache 共用規範與 PDF（等到第一批開始才建立，見 ensure_model） ===
+    job.use_context_cache = len(job.todo) > 1
+    return job
+
+
+async def release_context_cache(job: PdfJob):
+    """刪除 context cache 並清除使用它的模型（已過期時忽略刪除錯誤）"""
+    context_cache, job.context_cache, job.model = job.context_cache, None, None
+    if context_cache is None:
+        return
+    try:
+        await asyncio.to_thread(context_cache.delete)
+    except Exception as e:
+        logger.warning(f"⚠️ 無法刪除 context cache：{e}")
+
+
+async def ensure_model(job: PdfJob):
+    """批次執行前才建立 context cache 與模型，避免排隊等候時快取過期；快取將到期時先延長效期"""
+    async with job.model_lock:
+        if job.context_cache is not None and job.cache_expires_at - datetime.now(timezone.utc) < CONTEXT_CACHE_MARGIN:
+            try:
+                await asyncio.to_thread(job.context_cache.update, ttl=CONTEXT_CACHE_TTL)
+                job.cache_expires_at = datetime.now(timezone.utc) + CONTEXT_CACHE_TTL
+                logger.info(f"⏳ 已延長 context cache 效期：{job.context_cache.name}")
+            except Exception as e:
+                logger.warning(f"⚠️ 無法延長 context cache，將重新建立：{e}")
+                await release_context_cache(job)
+
+        if job.model is not None:
+            return
+
+        if job.use_context_cache and not job.context_cache_disabled:
+            job.context_cache = await create_context_cache(job.uploaded_file)
+            if job.context_cache is None:
+                job.context_cache_disabled = True  # 建立失敗時不再每批重試
+        if job.context_cache is not None:
+            job.cache_expires_at = datetime.now(timezone.utc) + CONTEXT_CACHE_TTL
+            logger.info(f"🧠 已建立 context cache：{job.context_cache.name}")
+            job.model = genai.GenerativeModel.from_cached_content(cached_content=job.context_cache)
+        else:
+            job.model = genai.GenerativeModel(
+                model_name=MODEL_NAME,
+                system_instruction=SPEC_PROMPT
+            )
+
+
+def is_context_cache_error(e: Exception) -> bool:
+    """判斷是否為 context cache 已過期或不存在的錯誤（其他權限或找不到檔案的錯誤照常回報）"""
+    return (
+        isinstance(e, (google_exceptions.NotFound, google_exceptions.PermissionDenied))
+        and "cachedcontent" in str(e).lower()
+    )
+
+
+def split_batch(job: PdfJob, start_page: int, end_page: int) -> list:
+    """把批次對半拆開，並在快取中記錄拆分點，下次執行直接沿用"""
+    split_at = (start_page + end_page) // 2
+    key = job.cache_key(start_page, end_page)
+    if key is not None:
+        cache_put(key, split_at=split_at)
+
+    # 拆半後至少有兩批要送，改用 context cache，讓各半不必重送整份 PDF 與規範
+    if not job.use_context_cache:
+        job.use_context_cache = True
+        if job.context_cache is None and not job.context_cache_disabled:
+            job.model = None  # 下一批由 ensure_model 改以 context cache 建立模型
+    return [(start_page, split_at), (split_at + 1, end_page)]
+
+
+async def run_batch(job: PdfJob, start_page: int, end_page: int, limiter: AsyncLimiter) -> list:
+    """處理單一批次並存入 job.results；批次過大需拆半時回傳拆出的頁碼範圍"""
+    can_split = end_page - start_page + 1 > MIN_CHUNK_SIZE
+    logger.info(f"\n[{job.name}] 處理頁碼: {start_page}–{end_page}")
+
+    # === 呼叫 Gemini ===
+    context_cache = None
+    try:
+        await ensure_model(job)
+        model, context_cache = job.model, job.context_cache  # 其他批次可能在呼叫期間重建快取
+        prompt = build_prompt(start_page, end_page)
+        if context_cache is not None:
+            contents = [prompt]
+        else:
+            contents = [job.uploaded_file, prompt]
+        for attempt in range(1, VALIDATION_ATTEMPTS + 1):
+            text, finish_reason = await generate_with_retry(model, contents, limiter)
+
+            # === 輸出被截斷：拆成兩批重送 ===
+            if finish_reason == "MAX_TOKENS" and can_split:
+                logger.warning(f"✂️ {job.name} 第 {start_page}–{end_page} 頁輸出超過上限，拆成兩批重新處理。")
+                return split_batch(job, start_page, end_page)
+
+            # === 格式檢查：頁碼標註太少時附上錯誤說明重試 ===
+            marker_count = len(MARKER_PATTERN.findall(text))
+            valid = marker_count >= marker_floor(start_page, end_page)
+            if valid or attempt == VALIDATION_ATTEMPTS:
+                break
+            if not text.strip():
+                # 沒有輸出可回饋（空白的 model 回合會被 API 拒絕），直接重送原請求
+                logger.warning(f"🩹 {job.name} 第 {start_page}–{end_page} 頁沒有輸出，重新送出。")
+                continue
+            logger.warning(f"🩹 {job.name} 第 {start_page}–{end_page} 頁格式不符（{marker_count} 個頁碼標註），附上錯誤說明重試。")
+            # 把上一次的輸出作為 model 回合送回，模型才看得到錯誤說明所指的內容
+            contents = [
+                {"role": "user", "parts": contents},
+                {"role": "model", "parts": [text]},
+                {"role": "user", "parts": [build_feedback(marker_count)]},
+            ]
+
+        # === 檢查回應 ===
+        if not text.strip():
+            logger.warning(f"⚠️ 無回應內容或模型未返回文字（{job.name} 第 {start_page}–{end_page} 頁）。")
+            job.set_result(start_page, end_page)
+        else:
+            job.set_result(start_page, end_page, text)
+            key = job.cache_key(start_page, end_page)
+            if finish_reason == "MAX_TOKENS":
+                logger.warning(f"⚠️ {job.name} 第 {start_page}–{end_page} 頁輸出可能不完整（已達輸出上限），不寫入快取。")
+            elif not valid:
+                logger.warning(f"⚠️ {job.name} 第 {start_page}–{end_page} 頁格式仍不符，保留輸出但不寫入快取。")
+            elif key is not None:
+                cache_put(key, text=text)
+
+    except Exception as e:
+        # === context cache 已失效：重建後重新排入這一批，不把錯誤寫進輸出 ===
+        if context_cache is not None and is_context_cache_error(e):
+            async with job.model_lock:
+                if job.context_cache is context_cache:  # 同一個快取失效只重建一次
+                    job.cache_recreated += 1
+                    if job.cache_recreated > CONTEXT_CACHE_RECREATE_LIMIT:
+                        job.context_cache_disabled = True
+                    logger.warning(f"♻️ {job.name} 的 context cache 已失效，重新處理第 {start_page}–{end_page} 頁：{e}")
+                    await release_context_cache(job)
+            return [(start_page, end_page)]
+
+        # === 輸入過長：拆成兩批重送 ===
+        if isinstance(e, google_exceptions.InvalidArgument) and "token" in str(e).lower() and can_split:
+            logger.warning(f"✂️ {job.name} 第 {start_page}–{end_page} 頁輸入過長，拆成兩批重新處理。")
+            return split_batch(job, start_page, end_page)
+
+        error_msg = f"❌ 第 {start_page}–{end_page} 頁錯誤：{e}\n"
+        logger.error(f"{job.name} {error_msg.rstrip()}")
+        job.results[start_page] = (end_page, error_msg)
+
+    logger.info(f"📊 {job.name} 進度: {job.pages_done / job.total_pages * 100:.1f}%（第 {start_page}–{end_page} 頁完成）")
+    return []
+
+
+async def finish_pdf(job: PdfJob):
+    """所有批次完成後，寫完剩餘內容、換成正式輸出檔並釋放 context cache"""
+    # === 寫完剩餘批次（整個 PDF 只 fsync 一次），完成後才換成正式檔名 ===
+    job.drain()
+    os.fsync(job.output.fileno())
+    job.output.close()
+    os.replace(job.part_path, job.output_file_path)  # 中斷時不會留下被當成已完成而跳過的半個檔案
+
+    await release_context_cache(job)
+
+    logger.info(f"✅ 已寫入 {job.output_file_path}")
+    logger.info(f"📦 檔案目前大小：{os.path.getsize(job.output_file_path)/1024:.1f} KB")
+
+    logger.info(f"\n🏁 === {job.name} 所有頁面處理完畢！ ===")
+
+
+async def batch_worker(queue: asyncio.Queue, limiter: AsyncLimiter):
+    """從共用佇列取出批次執行，直到收到 None"""
+    while True:
+        item = await queue.get()
+        if item is None:
+            queue.task_done()
+            return
+
+        job, start_page, end_page = item
+        try:
+            new_ranges = await run_batch(job, start_page, end_page, limiter)
+        except Exception as e:
+            error_msg = f"❌ 第 {start_page}–{end_page} 頁錯誤：{e}\n"
+            logger.error(f"{job.name} {error_msg.rstrip()}")
+            job.results[start_page] = (end_page, error_msg)
+            new_ranges = []
+
+        for new_start, new_end in new_ranges:
+            queue.put_nowait((job, new_start, new_end))
+        job.pending += len(new_ranges) - 1
+
+        try:
+            if job.pending == 0:
+                await finish_pdf(job)
+            else:
+                job.drain()  # 前面的批次都完成時立即寫入，不必等整份 PDF
+        except Exception as e:
+            logger.error(f"❌ 寫入 {job.output_file_path} 時發生錯誤：{e}")
+        finally:
+            queue.task_done()
+
+
+async def extract_pdfs(items: list, chunk_size: int = None, use_cache: bool = True):
+    """以共用佇列處理多個 PDF：批次（而非整份 PDF）是排程單位，N 個 worker 輪流取用"""
+    queue = asyncio.Queue()
+    limiter = AsyncLimiter(GEMINI_RPM, 60)  # token bucket：本次執行的所有 PDF、所有批次共用
+    workers = [asyncio.create_task(batch_worker(queue, limiter)) for _ in range(GEN_PARALLEL)]
+    semaphore = asyncio.Semaphore(PDF_CONCURRENCY)
+    upload_semaphore = asyncio.Semaphore(UPLOAD_PARALLEL)  # 每次執行各自建立，不跨 event loop 共用
+
+    async def enqueue_pdf(pdf_path: str, output_file_path: str):
+        async with semaphore:
+            logger.info(f"\n🔹 開始處理 PDF：{pdf_path}")
+            job = await prepare_pdf(pdf_path, output_file_path, chunk_size, use_cache, upload_semaphore)
+        if job is None:
+            return
+        if not job.todo:
+            await finish_pdf(job)
+            return
+        logger.info(f"\n🚀 === {job.name} 開始分批擷取 PDF 內容（{len(job.todo)} 批，單輪 + 頁碼標註） ===")
+        job.pending = len(job.todo)
+        for start_page, end_page in job.todo:
+            queue.put_nowait((job, start_page, end_page))
+
+    tasks = [enqueue_pdf(pdf_path, output_file_path) for pdf_path, output_file_path in items]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for (pdf_path, _), result in zip(items, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ 處理 {pdf_path} 時發生錯誤：{result}")
+
+    await queue.join()
+    for _ in workers:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+
+
+async def process_large_pdf(pdf_path: str, output_file_path: str, chunk_size: int = None, use_cache: bool = True):
+    """單輪分片方式擷取 PDF 內容（每批獨立呼叫模型，並自動頁碼標註）"""
+    await extract_pdfs([(pdf_path, output_file_path)], chunk_size, use_cache)
+
+
+# === 執行入口 ===
+def configure_api() -> bool:
+    """從環境變數讀取 API 金鑰並設定 Gemini，失敗時回傳 False"""
+    api_key = os.getenv("GOOGLE_API_KEY")
+
+    if not api_key:
+        logger.error("❌ 錯誤：找不到 GOOGLE_API_KEY。請建立 .env 檔案，內容如下：")
+        logger.error("GOOGLE_API_KEY=你的金鑰")
+        return False
+
+    try:
+        genai.configure(api_key=api_key)
+        logger.info("✅ Google API 金鑰設定成功！")
+    except Exception as e:
+        logger.error(f"❌ 設定 API 金鑰時發生錯誤: {e}")
+        return False
+    return True
+
+
+def find_pdf_files(input_path: str):
+    """列出要處理的 PDF（目錄內依檔案大小由大到小排序），找不到時回傳 None"""
+    if os.path.isdir(input_path):
+        with os.scandir(input_path) as it:
+            entries = [e for e in it if e.is_file() and e.name.lower().endswith(".pdf")]
+        entries.sort(key=lambda e: e.stat().st_size, reverse=True)  # 大檔先處理，避免最後只剩大檔在跑
+        if not entries:
+            logger.error(f"❌ 目錄 {input_path} 中沒有 PDF 檔案。")
+            return None
+        return [e.path for e in entries]
+
+    if os.path.isfile(input_path) and input_path.lower().endswith(".pdf"):
+        return [input_path]  # 單一 PDF
+
+    logger.error(f"❌ 找不到 PDF 或目錄：{input_path}")
+    return None
+
+
+async def run(pdf_files: list, chunk_size: int = None, use_cache: bool = True):
+    """處理多個 PDF，輸出檔與原 PDF 同目錄；已存在的輸出檔會跳過"""
+    items = []
+    for pdf_path in pdf_files:
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+
+        # 輸出檔與原 PDF 同目錄
+        txt_output_file = os.path.join(os.path.dirname(pdf_path), f"{base_name}_extracted.txt")
+
+        if os.path.exists(txt_output_file):
+            logger.info(f"ℹ️ 已存在 {txt_output_file}，跳過此檔案。")
+            continue
+        items.append((pdf_path, txt_output_file))
+
+    await extract_pdfs(items, chunk_size, use_cache)
+
+    logger.info(f"\n📈 重試統計：429 × {RETRY_COUNTS[429]}、503 × {RETRY_COUNTS[503]}、504 × {RETRY_COUNTS[504]}")
+
+
+def main(argv: list, prog: str) -> int:
+    """命令列入口：<PDF目錄路徑或單一PDF路徑> [每批頁數] [--no-cache] [-q]"""
+    flags = {arg for arg in argv if arg.startswith("-")}
+    args = [arg for arg in argv if not arg.startswith("-")]
+
+    listener = setup_logging(quiet=bool(flags & {"-q", "--quiet"}))
+    try:
+        if not configure_api():
+            return 1
+
+        if len(args) < 1:
+            print("\n📘 使用方式：")
+            print(f"python {prog} <PDF目錄路徑或單一PDF路徑> [每批頁數] [--no-cache] [-q]\n")
+            print(f"範例：python {prog} ./pdfs 30\n")
+            return 0
+
+        chunk_size = int(args[1]) if len(args) > 1 else None  # 未指定時自動決定
+
+        pdf_files = find_pdf_files(args[0])
+        if not pdf_files:
+            return 1
+
+        logger.info(f"🟢 發現 {len(pdf_files)} 個 PDF 檔案，開始處理...\n")
+        asyncio.run(run(pdf_files, chunk_size, use_cache="--no-cache" not in flags))
+        return 0
+    finally:
+        listener.stop()